@@ -0,0 +1,124 @@
+import os
+import sys
+# DON'T CHANGE THIS !!!
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+# Benchmark for /api/locations/batch with offline phones replaying batches.
+#
+#   python bench_ingest.py [devices] [batches_per_device] [batch_size]
+#
+# 30% of the requests are resends of an earlier batch and every device
+# flushes its backlog in shuffled order. The "naive" run stores the same
+# traffic with a per-ping existence query before each insert, which is
+# what the endpoint replaces.
+
+from flask import Flask
+from datetime import datetime, timedelta
+import random
+import time
+
+from src.models.user import db
+from src.models.location import LocationPing
+from src.routes.ingest import location_bp
+
+REPLAY_RATIO = 0.3
+
+
+def build_traffic(devices, batches_per_device, batch_size, seed=42):
+    rng = random.Random(seed)
+    base = datetime(2025, 8, 1, 22, 0, 0)
+    traffic = []
+    for d in range(devices):
+        device_id = f"device-{d}"
+        sent = []
+        for b in range(batches_per_device):
+            seq_start = b * batch_size + 1
+            pings = []
+            for i in range(batch_size):
+                # Spread fixes over several hours so batches cross day partitions
+                recorded_at = base + timedelta(minutes=(seq_start + i) * 3)
+                pings.append({
+                    "latitude": 40.0 + rng.random(),
+                    "longitude": -74.0 + rng.random(),
+                    "accuracy": 5.0,
+                    "recorded_at": recorded_at.isoformat() + "Z"
+                })
+            sent.append({
+                "device_id": device_id,
+                "seq_start": seq_start,
+                "seq_end": seq_start + batch_size - 1,
+                "pings": pings
+            })
+        rng.shuffle(sent)
+        traffic.extend(sent)
+
+    replays = [rng.choice(traffic) for _ in range(int(len(traffic) * REPLAY_RATIO / (1 - REPLAY_RATIO)))]
+    for batch in replays:
+        traffic.insert(rng.randrange(len(traffic) + 1), batch)
+    return traffic, len(replays)
+
+
+def create_app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    app.register_blueprint(location_bp, url_prefix='/api/locations')
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def run_endpoint(traffic):
+    app = create_app()
+    client = app.test_client()
+    started = time.perf_counter()
+    for batch in traffic:
+        response = client.post('/api/locations/batch', json=batch)
+        assert response.status_code == 200, response.get_json()
+    elapsed = time.perf_counter() - started
+    with app.app_context():
+        stored = LocationPing.query.count()
+    return elapsed, stored
+
+
+def run_naive(traffic):
+    app = create_app()
+    started = time.perf_counter()
+    with app.app_context():
+        for batch in traffic:
+            for offset, ping in enumerate(batch["pings"]):
+                seq = batch["seq_start"] + offset
+                exists = LocationPing.query.filter_by(device_id=batch["device_id"], seq=seq).first()
+                if exists:
+                    continue
+                recorded_at = datetime.fromisoformat(ping["recorded_at"].replace("Z", ""))
+                db.session.add(LocationPing(
+                    device_id=batch["device_id"],
+                    seq=seq,
+                    latitude=ping["latitude"],
+                    longitude=ping["longitude"],
+                    accuracy=ping["accuracy"],
+                    recorded_at=recorded_at,
+                    partition_day=recorded_at.date()
+                ))
+            db.session.commit()
+        elapsed = time.perf_counter() - started
+        stored = LocationPing.query.count()
+    return elapsed, stored
+
+
+if __name__ == '__main__':
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    batches_per_device = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+    traffic, replayed = build_traffic(devices, batches_per_device, batch_size)
+    expected = devices * batches_per_device * batch_size
+    print(f"{len(traffic)} batches ({replayed} replayed), {expected} unique pings")
+
+    for name, runner in (("naive", run_naive), ("endpoint", run_endpoint)):
+        elapsed, stored = runner(traffic)
+        assert stored == expected, f"{name}: stored {stored}, expected {expected}"
+        print(f"{name:>8}: {elapsed:.3f}s  {len(traffic) / elapsed:,.0f} batches/s  "
+              f"{expected / elapsed:,.0f} pings/s")
@@ -0,0 +1,452 @@
+from flask import Blueprint, request, jsonify, current_app
+from src.models.user import db
+from src.models.location import LocationPing, LatestLocation, DeviceWatermark
+from flask_cors import CORS
+from sqlalchemy import insert, update, or_, and_
+from sqlalchemy.exc import IntegrityError
+from collections import OrderedDict
+from datetime import datetime, timezone
+import atexit
+import bisect
+import math
+import threading
+import traceback
+import time
+
+location_bp = Blueprint("location", __name__)
+CORS(location_bp)
+
+MAX_BATCH_SIZE = 500
+MAX_DEVICE_ID_LENGTH = 64
+MAX_SEQ = 2 ** 63 - 1
+
+
+class BatchInFlight(Exception):
+    """Raised when a batch overlaps seqs another request is still storing."""
+
+
+class _DeviceState:
+    __slots__ = ("high_water", "ranges", "in_flight")
+
+    def __init__(self, high_water=0, ranges=None):
+        self.high_water = high_water
+        self.ranges = ranges or []
+        self.in_flight = []
+
+
+def _parse_ranges(text):
+    ranges = []
+    for part in (text or "").split(","):
+        if part:
+            start, end = part.split("-")
+            ranges.append([int(start), int(end)])
+    return ranges
+
+
+def _format_ranges(ranges):
+    return ",".join(f"{start}-{end}" for start, end in ranges)
+
+
+def _overlaps(ranges, start, end):
+    return any(s <= end and start <= e for s, e in ranges)
+
+
+class DeviceSequenceTracker:
+    """Per-device sequence high-water marks used to drop replayed batches.
+
+    Every seq up to ``high_water`` is known to be stored; anything stored
+    above it (late or out-of-order batches) is kept as a short list of
+    merged ranges until the gap below it fills in. A fully replayed batch
+    is rejected with a single comparison and never touches the database.
+
+    Seqs move into ``high_water``/``ranges`` only through ``commit()``,
+    after the pings are in the database. Until then they are held as
+    in-flight claims, and a batch overlapping one raises BatchInFlight so
+    the phone retries instead of being told the data is stored.
+
+    State lives in process memory, at most ``max_devices`` devices (least
+    recently used first out) and ``max_ranges`` pending ranges per device.
+    It is written to ``DeviceWatermark`` rows by ``flush()`` at most every
+    ``flush_interval`` seconds and at shutdown. Anything the tracker
+    forgets (eviction, dropped ranges, restart, another gunicorn worker) is
+    still kept out of the history table by the unique (device_id, seq)
+    constraint.
+    """
+
+    def __init__(self, flush_interval=30, max_devices=10000, max_ranges=64):
+        self.flush_interval = flush_interval
+        self.max_devices = max_devices
+        self.max_ranges = max_ranges
+        self._devices = OrderedDict()
+        self._dirty = set()
+        self._evicted = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def init_app(self, app):
+        self.flush_interval = app.config.get('LOCATION_WATERMARK_FLUSH_SECONDS', self.flush_interval)
+        self.max_devices = app.config.get('LOCATION_TRACKER_MAX_DEVICES', self.max_devices)
+        self.max_ranges = app.config.get('LOCATION_TRACKER_MAX_RANGES', self.max_ranges)
+        atexit.register(self._flush_at_exit, app)
+
+    def _flush_at_exit(self, app):
+        try:
+            with app.app_context():
+                self.flush(force=True)
+        except Exception as e:
+            app.logger.error(f"Watermark flush at shutdown failed: {str(e)}")
+
+    def _load(self, device_id):
+        row = db.session.get(DeviceWatermark, device_id)
+        if row is None:
+            return _DeviceState()
+        return _DeviceState(row.high_water, _parse_ranges(row.pending_ranges))
+
+    def _prefetch(self, device_id):
+        """Load a device's watermark if it is not cached, without holding the lock."""
+        with self._lock:
+            if device_id in self._devices or device_id in self._evicted:
+                return None
+        return self._load(device_id)
+
+    def _state(self, device_id, loaded):
+        state = self._devices.get(device_id)
+        if state is not None:
+            self._devices.move_to_end(device_id)
+            return state
+
+        state = self._evicted.pop(device_id, None)
+        if state is not None:
+            # Still not written out, so keep it queued for the next flush
+            self._dirty.add(device_id)
+        else:
+            # Another request may have loaded and evicted it since the
+            # prefetch; starting empty only costs the DB constraint a check
+            state = loaded or _DeviceState()
+        self._devices[device_id] = state
+        self._evict(keep=device_id)
+        return state
+
+    def _evict(self, keep):
+        for device_id in list(self._devices):
+            if len(self._devices) <= self.max_devices:
+                break
+            state = self._devices[device_id]
+            if device_id == keep or state.in_flight:
+                continue
+            del self._devices[device_id]
+            if device_id in self._dirty:
+                # Keep it until the next flush writes it out
+                self._dirty.discard(device_id)
+                self._evicted[device_id] = state
+
+    def claim(self, device_id, seq_start, seq_end):
+        """Reserve the seqs in [seq_start, seq_end] not stored yet and return them as ranges.
+
+        The caller must follow up with ``commit()`` once the pings are in
+        the database, or ``release()`` if storing them failed.
+        """
+        loaded = self._prefetch(device_id)
+        with self._lock:
+            state = self._state(device_id, loaded)
+
+            if seq_end <= state.high_water:
+                return []
+
+            cursor = max(seq_start, state.high_water + 1)
+            fresh = []
+            for start, end in state.ranges:
+                if end < cursor:
+                    continue
+                if start > seq_end:
+                    break
+                if start > cursor:
+                    fresh.append((cursor, start - 1))
+                cursor = max(cursor, end + 1)
+                if cursor > seq_end:
+                    break
+            if cursor <= seq_end:
+                fresh.append((cursor, seq_end))
+
+            for start, end in fresh:
+                if _overlaps(state.in_flight, start, end):
+                    raise BatchInFlight(device_id)
+            state.in_flight.extend(fresh)
+            return fresh
+
+    def commit(self, device_id, fresh):
+        """Record claimed ranges as stored. Call only after the DB commit succeeded."""
+        loaded = self._prefetch(device_id)
+        with self._lock:
+            state = self._state(device_id, loaded)
+            for start, end in fresh:
+                if (start, end) in state.in_flight:
+                    state.in_flight.remove((start, end))
+                self._mark(state, start, end, self.max_ranges)
+            self._dirty.add(device_id)
+
+    def release(self, device_id, fresh):
+        """Drop claimed ranges that were not stored so the batch can be retried."""
+        with self._lock:
+            state = self._devices.get(device_id)
+            if state is None:
+                return
+            for claimed in fresh:
+                if claimed in state.in_flight:
+                    state.in_flight.remove(claimed)
+
+    @staticmethod
+    def _mark(state, seq_start, seq_end, max_ranges):
+        ranges = state.ranges
+        i = bisect.bisect_left(ranges, [seq_start, seq_end])
+        ranges.insert(i, [seq_start, seq_end])
+        if i > 0 and ranges[i - 1][1] + 1 >= seq_start:
+            i -= 1
+        while i + 1 < len(ranges) and ranges[i + 1][0] <= ranges[i][1] + 1:
+            ranges[i][1] = max(ranges[i][1], ranges[i + 1][1])
+            del ranges[i + 1]
+
+        if ranges and ranges[0][0] <= state.high_water + 1:
+            state.high_water = max(state.high_water, ranges.pop(0)[1])
+
+        # Beyond the cap, forget the highest ranges and let the DB constraint catch replays
+        del ranges[max_ranges:]
+
+    def forget(self, device_id):
+        """Drop cached state so the next batch reloads it from the database."""
+        with self._lock:
+            self._devices.pop(device_id, None)
+            self._evicted.pop(device_id, None)
+            self._dirty.discard(device_id)
+
+    def flush(self, force=False):
+        """Write committed watermarks to the database if the interval has elapsed.
+
+        Commits its own transaction, so it must be called after the
+        request's pings have been committed. Returns the number of devices
+        written.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_flush < self.flush_interval:
+                return 0
+            self._last_flush = now
+            snapshot = {
+                device_id: (state.high_water, _format_ranges(state.ranges))
+                for device_id, state in self._evicted.items()
+            }
+            for device_id in self._dirty:
+                state = self._devices[device_id]
+                snapshot[device_id] = (state.high_water, _format_ranges(state.ranges))
+            evicted, self._evicted = self._evicted, {}
+            self._dirty = set()
+
+        try:
+            for device_id, (high_water, pending_ranges) in snapshot.items():
+                db.session.merge(DeviceWatermark(
+                    device_id=device_id,
+                    high_water=high_water,
+                    pending_ranges=pending_ranges
+                ))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                for device_id, state in evicted.items():
+                    self._evicted.setdefault(device_id, state)
+                self._dirty.update(device_id for device_id in snapshot if device_id in self._devices)
+            raise
+        return len(snapshot)
+
+
+sequence_tracker = DeviceSequenceTracker()
+
+
+@location_bp.record_once
+def _init_tracker(state):
+    sequence_tracker.init_app(state.app)
+
+
+def _parse_timestamp(value):
+    if not isinstance(value, str):
+        raise ValueError("recorded_at must be an ISO 8601 string")
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def _insert_ignoring_conflicts(model, rows, index_elements):
+    """Insert rows, skipping any that collide on ``index_elements``.
+
+    Returns the number of rows actually inserted.
+    """
+    dialect = db.engine.dialect.name
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    elif dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        # No ON CONFLICT support: insert row by row, each in its own savepoint
+        inserted = 0
+        for row in rows:
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(insert(model), row)
+                inserted += 1
+            except IntegrityError:
+                pass
+        return inserted
+    primary_key = model.__table__.primary_key.columns.values()[0]
+    stmt = (dialect_insert(model)
+            .on_conflict_do_nothing(index_elements=index_elements)
+            .returning(primary_key))
+    return len(db.session.execute(stmt, rows).all())
+
+
+def _update_latest(device_id, newest):
+    """Move the device's latest position to ``newest`` only if it is a newer fix.
+
+    The comparison happens in the UPDATE itself, so concurrent batches for
+    the same device cannot move it backwards.
+    """
+    is_older = or_(
+        LatestLocation.recorded_at < newest["recorded_at"],
+        and_(LatestLocation.recorded_at == newest["recorded_at"], LatestLocation.seq < newest["seq"])
+    )
+    stmt = (update(LatestLocation)
+            .where(LatestLocation.device_id == device_id, is_older)
+            .values(**newest)
+            .execution_options(synchronize_session=False))
+
+    if db.session.execute(stmt).rowcount:
+        return True
+    if _insert_ignoring_conflicts(LatestLocation, [dict(newest, device_id=device_id)], ["device_id"]):
+        return True
+    # Another batch created the first row in the meantime; it may be older
+    return bool(db.session.execute(stmt).rowcount)
+
+
+def _is_seq(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+@location_bp.route("/batch", methods=["POST"])
+def ingest_batch():
+    device_id = None
+    fresh = []
+    try:
+        data = request.get_json()
+
+        if not data:
+            return jsonify({"message": "No data provided"}), 400
+
+        device_id = str(data.get("device_id", "")).strip()
+        seq_start = data.get("seq_start")
+        seq_end = data.get("seq_end")
+        pings = data.get("pings")
+
+        if not device_id or not isinstance(pings, list):
+            return jsonify({"message": "Missing required fields: device_id, seq_start, seq_end, pings"}), 400
+
+        if len(device_id) > MAX_DEVICE_ID_LENGTH:
+            return jsonify({"message": f"device_id is limited to {MAX_DEVICE_ID_LENGTH} characters"}), 400
+
+        if (not _is_seq(seq_start) or not _is_seq(seq_end)
+                or seq_start < 1 or seq_end < seq_start or seq_end > MAX_SEQ):
+            return jsonify({"message": f"seq_start and seq_end must be integers with 1 <= seq_start <= seq_end <= {MAX_SEQ}"}), 400
+
+        if len(pings) != seq_end - seq_start + 1:
+            return jsonify({"message": "Number of pings must match the sequence range"}), 400
+
+        if len(pings) > MAX_BATCH_SIZE:
+            return jsonify({"message": f"Batches are limited to {MAX_BATCH_SIZE} pings"}), 400
+
+        # Validate before claiming so a rejected batch can be resent later
+        parsed = []
+        for offset, ping in enumerate(pings):
+            try:
+                recorded_at = _parse_timestamp(ping.get("recorded_at"))
+                latitude = float(ping["latitude"])
+                longitude = float(ping["longitude"])
+                accuracy = float(ping["accuracy"]) if ping.get("accuracy") is not None else None
+                if not (math.isfinite(latitude) and -90 <= latitude <= 90):
+                    raise ValueError("latitude out of range")
+                if not (math.isfinite(longitude) and -180 <= longitude <= 180):
+                    raise ValueError("longitude out of range")
+                if accuracy is not None and not math.isfinite(accuracy):
+                    raise ValueError("accuracy must be finite")
+                parsed.append({
+                    "seq": seq_start + offset,
+                    "latitude": latitude,
+                    "longitude": longitude,
+                    "accuracy": accuracy,
+                    "recorded_at": recorded_at
+                })
+            except (AttributeError, KeyError, TypeError, ValueError, OverflowError):
+                return jsonify({"message": f"Invalid ping at seq {seq_start + offset}"}), 400
+
+        try:
+            fresh = sequence_tracker.claim(device_id, seq_start, seq_end)
+        except BatchInFlight:
+            return jsonify({
+                "message": "Batch overlaps one that is still being stored. Please retry the batch.",
+                "retry": True
+            }), 409
+
+        if not fresh:
+            return jsonify({
+                "message": "Batch already received",
+                "accepted": 0,
+                "duplicates": len(parsed),
+                "latest_updated": False
+            }), 200
+
+        rows = []
+        for start, end in fresh:
+            for ping in parsed[start - seq_start:end - seq_start + 1]:
+                rows.append(dict(
+                    ping,
+                    device_id=device_id,
+                    partition_day=ping["recorded_at"].date()
+                ))
+
+        accepted = _insert_ignoring_conflicts(LocationPing, rows, ["device_id", "seq"])
+
+        newest = max(rows, key=lambda row: (row["recorded_at"], row["seq"]))
+        latest_updated = _update_latest(device_id, {
+            "seq": newest["seq"],
+            "latitude": newest["latitude"],
+            "longitude": newest["longitude"],
+            "accuracy": newest["accuracy"],
+            "recorded_at": newest["recorded_at"]
+        })
+
+        db.session.commit()
+        sequence_tracker.commit(device_id, fresh)
+        fresh = []
+
+    except Exception as e:
+        db.session.rollback()
+        if fresh:
+            sequence_tracker.release(device_id, fresh)
+        current_app.logger.error(f"Location ingest error: {str(e)}")
+        current_app.logger.error(f"Traceback: {traceback.format_exc()}")
+        return jsonify({
+            "message": "Ingest failed",
+            "error": "An unexpected error occurred. Please retry the batch."
+        }), 500
+
+    # The pings are stored; a failed watermark write only costs dedupe speed
+    try:
+        sequence_tracker.flush()
+    except Exception as e:
+        current_app.logger.error(f"Watermark flush error: {str(e)}")
+
+    return jsonify({
+        "message": "Batch ingested",
+        "accepted": accepted,
+        "duplicates": len(parsed) - accepted,
+        "latest_updated": latest_updated
+    }), 200
+
@@ -0,0 +1,64 @@
+from src.models.user import db
+from datetime import datetime
+
+
+class LocationPing(db.Model):
+    __table_args__ = (
+        # Last line of defence against replays that slip past the in-memory tracker
+        db.UniqueConstraint('device_id', 'seq', name='uq_location_ping_device_seq'),
+        # History is partitioned by the day the fix was recorded on the phone
+        db.Index('ix_location_ping_partition', 'device_id', 'partition_day', 'recorded_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(64), nullable=False)
+    seq = db.Column(db.BigInteger, nullable=False)
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
+    accuracy = db.Column(db.Float)
+
+    # Timestamps
+    recorded_at = db.Column(db.DateTime, nullable=False)
+    partition_day = db.Column(db.Date, nullable=False)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'device_id': self.device_id,
+            'seq': self.seq,
+            'latitude': self.latitude,
+            'longitude': self.longitude,
+            'accuracy': self.accuracy,
+            'recorded_at': self.recorded_at.isoformat() if self.recorded_at else None,
+            'received_at': self.received_at.isoformat() if self.received_at else None
+        }
+
+
+class LatestLocation(db.Model):
+    device_id = db.Column(db.String(64), primary_key=True)
+    seq = db.Column(db.BigInteger, nullable=False)
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
+    accuracy = db.Column(db.Float)
+    recorded_at = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'device_id': self.device_id,
+            'seq': self.seq,
+            'latitude': self.latitude,
+            'longitude': self.longitude,
+            'accuracy': self.accuracy,
+            'recorded_at': self.recorded_at.isoformat() if self.recorded_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+
+class DeviceWatermark(db.Model):
+    device_id = db.Column(db.String(64), primary_key=True)
+    # Every seq <= high_water has been stored
+    high_water = db.Column(db.BigInteger, nullable=False, default=0)
+    # Stored ranges above high_water, as "start-end,start-end"
+    pending_ranges = db.Column(db.Text, default='')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
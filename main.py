@@ -14,10 +14,17 @@ from logging.handlers import RotatingFileHandler
 from src.models.user import db, User
 from src.routes.user import user_bp
 from src.routes.auth import auth_bp
+from src.routes.ingest import location_bp
+from src.routes.profiling import RequestProfiler
 
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'location-tracker-secret-key-change-in-production')
 
+# Location ingestion (read by the location blueprint when it is registered)
+app.config['LOCATION_WATERMARK_FLUSH_SECONDS'] = int(os.environ.get('LOCATION_WATERMARK_FLUSH_SECONDS', 30))
+app.config['LOCATION_TRACKER_MAX_DEVICES'] = int(os.environ.get('LOCATION_TRACKER_MAX_DEVICES', 10000))
+app.config['LOCATION_TRACKER_MAX_RANGES'] = int(os.environ.get('LOCATION_TRACKER_MAX_RANGES', 64))
+
 # CORS configuration
 CORS(app, origins=["http://localhost:3000", "http://localhost:5173", "*"])
 
@@ -35,6 +42,7 @@ mail = Mail(app)
 # Register blueprints
 app.register_blueprint(user_bp, url_prefix='/api')
 app.register_blueprint(auth_bp, url_prefix='/api/auth')
+app.register_blueprint(location_bp, url_prefix='/api/locations')
 
 # Database configuration
 app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(os.path.dirname(__file__), 'database', 'app.db')}"
@@ -44,6 +52,15 @@ db.init_app(app)
 with app.app_context():
     db.create_all()
 
+# Request profiling (off unless PROFILING_ENABLED=true)
+app.config['PROFILING_ENABLED'] = os.environ.get('PROFILING_ENABLED', 'false').lower() == 'true'
+app.config['PROFILING_SAMPLE_RATE'] = float(os.environ.get('PROFILING_SAMPLE_RATE', 1.0))
+app.config['PROFILING_INTERVAL'] = float(os.environ.get('PROFILING_INTERVAL', 0.01))
+app.config['PROFILING_SLOW_MS'] = float(os.environ.get('PROFILING_SLOW_MS', 500))
+app.config['PROFILING_MAX_PROFILES'] = int(os.environ.get('PROFILING_MAX_PROFILES', 50))
+app.config['PROFILING_ADMIN_TOKEN'] = os.environ.get('PROFILING_ADMIN_TOKEN')
+profiler = RequestProfiler(app, db)
+
 # Email verification function
 def send_verification_email(email, token, user_name):
     try:
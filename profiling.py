@@ -0,0 +1,326 @@
+from flask import Blueprint, request, jsonify, current_app, g, has_request_context, Response
+from sqlalchemy import event
+from collections import deque
+from datetime import datetime
+from functools import wraps
+import itertools
+import json
+import os
+import random
+import secrets
+import sys
+import threading
+import time
+import click
+
+profiling_bp = Blueprint("profiling", __name__)
+
+# Per-profile limits. Worst case a kept profile holds MAX_STACK_BYTES of
+# folded stacks plus MAX_SQL_PER_PROFILE statements and errors of up to
+# MAX_STATEMENT_LENGTH characters each, about 0.7 MB in total.
+MAX_STACK_DEPTH = 48
+MAX_STACKS_PER_PROFILE = 500
+MAX_STACK_BYTES = 256 * 1024
+MAX_SQL_PER_PROFILE = 200
+MAX_STATEMENT_LENGTH = 1000
+
+
+class _StackSampler(threading.Thread):
+    """Background thread that samples the Python stack of in-flight requests.
+
+    It only wakes up while at least one profiled request is running, and
+    records folded stacks ("outer;inner;leaf" -> count) that can be fed
+    straight into flamegraph.pl or speedscope.
+    """
+
+    def __init__(self, interval):
+        super().__init__(name="request-stack-sampler", daemon=True)
+        self.interval = interval
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def add(self, thread_id, profile):
+        with self._lock:
+            self._active[thread_id] = profile
+        self._wakeup.set()
+
+    def remove(self, thread_id):
+        with self._lock:
+            self._active.pop(thread_id, None)
+
+    def run(self):
+        while True:
+            if not self._active:
+                self._wakeup.clear()
+                # Re-check after clearing so a concurrent add() is not missed
+                if not self._active:
+                    self._wakeup.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, profile in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        self._record(profile, frame)
+
+    @staticmethod
+    def _record(profile, frame):
+        names = []
+        while frame is not None and len(names) < MAX_STACK_DEPTH:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        key = ";".join(reversed(names))
+
+        stacks = profile["stacks"]
+        profile["samples"] += 1
+        if key in stacks:
+            stacks[key] += 1
+        elif (len(stacks) < MAX_STACKS_PER_PROFILE
+              and profile["stack_bytes"] + len(key) <= MAX_STACK_BYTES):
+            stacks[key] = 1
+            profile["stack_bytes"] += len(key)
+        else:
+            profile["stacks_dropped"] += 1
+
+
+class RequestProfiler:
+    """Opt-in per-request profiler for the Flask app.
+
+    Nothing is hooked into the app unless PROFILING_ENABLED is set. When it
+    is, every request records its SQL statements and timings, a
+    PROFILING_SAMPLE_RATE fraction of requests also get stack samples taken
+    every PROFILING_INTERVAL seconds, and requests slower than
+    PROFILING_SLOW_MS are kept in a ring buffer of PROFILING_MAX_PROFILES
+    entries. Profiles live in process memory, one buffer per worker.
+    """
+
+    def __init__(self, app=None, db=None):
+        self.db = db
+        self.profiles = deque()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._sampler = None
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db=None):
+        app.config.setdefault('PROFILING_ENABLED', False)
+        app.config.setdefault('PROFILING_SAMPLE_RATE', 1.0)
+        app.config.setdefault('PROFILING_INTERVAL', 0.01)
+        app.config.setdefault('PROFILING_SLOW_MS', 500)
+        app.config.setdefault('PROFILING_MAX_PROFILES', 50)
+        app.config.setdefault('PROFILING_ADMIN_TOKEN', None)
+        app.extensions['profiler'] = self
+        app.cli.add_command(profiles_cli)
+
+        if not app.config['PROFILING_ENABLED']:
+            return
+
+        self.db = db or self.db
+        self.sample_rate = float(app.config['PROFILING_SAMPLE_RATE'])
+        self.slow_ms = float(app.config['PROFILING_SLOW_MS'])
+        self.profiles = deque(maxlen=int(app.config['PROFILING_MAX_PROFILES']))
+
+        if self.sample_rate > 0:
+            self._sampler = _StackSampler(float(app.config['PROFILING_INTERVAL']))
+            self._sampler.start()
+
+        if self.db is not None:
+            with app.app_context():
+                event.listen(self.db.engine, "before_cursor_execute", _before_cursor_execute)
+                event.listen(self.db.engine, "after_cursor_execute", _after_cursor_execute)
+                event.listen(self.db.engine, "handle_error", _handle_error)
+
+        app.before_request(self._start_request)
+        app.after_request(self._record_status)
+        app.teardown_request(self._finish_request)
+        app.register_blueprint(profiling_bp, url_prefix='/api/admin/profiles')
+        app.logger.info(f"Request profiling enabled (slow threshold {self.slow_ms:.0f} ms)")
+
+    def _start_request(self):
+        profile = {
+            "started": time.perf_counter(),
+            "started_at": datetime.utcnow().isoformat(),
+            "sql": [],
+            "sql_dropped": 0,
+            "sampled": False,
+            "samples": 0,
+            "stacks": {},
+            "stack_bytes": 0,
+            "stacks_dropped": 0,
+            "status": None
+        }
+        g._profile = profile
+        if self._sampler is not None and random.random() < self.sample_rate:
+            profile["sampled"] = True
+            self._sampler.add(threading.get_ident(), profile)
+
+    def _record_status(self, response):
+        profile = g.get('_profile')
+        if profile is not None:
+            profile["status"] = response.status_code
+        return response
+
+    def _finish_request(self, error=None):
+        profile = g.pop('_profile', None)
+        if profile is None:
+            return
+        if profile["sampled"]:
+            self._sampler.remove(threading.get_ident())
+
+        duration_ms = (time.perf_counter() - profile.pop("started")) * 1000
+        if duration_ms < self.slow_ms:
+            return
+
+        profile.update({
+            "method": request.method,
+            "path": request.path,
+            "endpoint": request.endpoint,
+            "duration_ms": round(duration_ms, 3),
+            "sql_ms": round(sum(query["duration_ms"] for query in profile["sql"]), 3),
+            "error": str(error) if error else None
+        })
+        if profile["status"] is None:
+            profile["status"] = 500
+        with self._lock:
+            profile["id"] = next(self._ids)
+            self.profiles.append(profile)
+
+    def list_profiles(self):
+        with self._lock:
+            profiles = list(self.profiles)
+        return [{
+            "id": profile["id"],
+            "method": profile["method"],
+            "path": profile["path"],
+            "endpoint": profile["endpoint"],
+            "status": profile["status"],
+            "duration_ms": profile["duration_ms"],
+            "sql_ms": profile["sql_ms"],
+            "sql_count": len(profile["sql"]) + profile["sql_dropped"],
+            "samples": profile["samples"],
+            "started_at": profile["started_at"]
+        } for profile in reversed(profiles)]
+
+    def get_profile(self, profile_id):
+        with self._lock:
+            for profile in self.profiles:
+                if profile["id"] == profile_id:
+                    return profile
+        return None
+
+    def clear(self):
+        with self._lock:
+            self.profiles.clear()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and has_request_context() and g.get('_profile') is not None:
+        context._profile_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _record_query(context, statement, executemany)
+
+
+def _handle_error(exception_context):
+    context = exception_context.execution_context
+    if context is not None and exception_context.statement is not None:
+        _record_query(context, exception_context.statement, context.executemany,
+                      error=exception_context.original_exception)
+
+
+def _record_query(context, statement, executemany, error=None):
+    started = getattr(context, '_profile_start', None)
+    if started is None:
+        return
+    context._profile_start = None
+    profile = g.get('_profile') if has_request_context() else None
+    if profile is None:
+        return
+    if len(profile["sql"]) >= MAX_SQL_PER_PROFILE:
+        profile["sql_dropped"] += 1
+        return
+    query = {
+        "statement": statement[:MAX_STATEMENT_LENGTH],
+        "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+        "executemany": executemany
+    }
+    if error is not None:
+        query["error"] = str(error)[:MAX_STATEMENT_LENGTH]
+    profile["sql"].append(query)
+
+
+def admin_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        token = current_app.config.get('PROFILING_ADMIN_TOKEN')
+        supplied = request.headers.get('X-Admin-Token', '')
+        if not token or not secrets.compare_digest(supplied.encode(), token.encode()):
+            return jsonify({"message": "Admin token required"}), 401
+        return f(*args, **kwargs)
+    return decorated
+
+
+@profiling_bp.route("", methods=["GET"])
+@admin_required
+def list_profiles():
+    profiler = current_app.extensions['profiler']
+    return jsonify({"profiles": profiler.list_profiles()}), 200
+
+
+@profiling_bp.route("", methods=["DELETE"])
+@admin_required
+def clear_profiles():
+    current_app.extensions['profiler'].clear()
+    return jsonify({"message": "Profiles cleared"}), 200
+
+
+@profiling_bp.route("/<int:profile_id>", methods=["GET"])
+@admin_required
+def get_profile(profile_id):
+    profile = current_app.extensions['profiler'].get_profile(profile_id)
+    if not profile:
+        return jsonify({"message": "Profile not found"}), 404
+    return jsonify(profile), 200
+
+
+@profiling_bp.route("/<int:profile_id>/folded", methods=["GET"])
+@admin_required
+def get_folded_stacks(profile_id):
+    profile = current_app.extensions['profiler'].get_profile(profile_id)
+    if not profile:
+        return jsonify({"message": "Profile not found"}), 404
+    folded = "\n".join(f"{stack} {count}" for stack, count in profile["stacks"].items())
+    return Response(folded + "\n", mimetype="text/plain")
+
+
+@click.group("profiles")
+def profiles_cli():
+    """Download request profiles from a running instance."""
+
+
+@profiles_cli.command("download")
+@click.argument("base_url")
+@click.option("--out", "out_dir", default="profiles", show_default=True, help="Directory to write profiles to.")
+@click.option("--token", envvar="PROFILING_ADMIN_TOKEN", required=True, help="Admin token (defaults to $PROFILING_ADMIN_TOKEN).")
+def download_profiles(base_url, out_dir, token):
+    """Save every profile held by BASE_URL as JSON plus folded stacks."""
+    from urllib.request import Request, urlopen
+
+    def fetch(path):
+        req = Request(f"{base_url.rstrip('/')}/api/admin/profiles{path}", headers={"X-Admin-Token": token})
+        with urlopen(req) as resp:
+            return resp.read()
+
+    os.makedirs(out_dir, exist_ok=True)
+    summaries = json.loads(fetch(""))["profiles"]
+    for summary in summaries:
+        profile_id = summary["id"]
+        with open(os.path.join(out_dir, f"profile-{profile_id}.json"), "wb") as f:
+            f.write(fetch(f"/{profile_id}"))
+        with open(os.path.join(out_dir, f"profile-{profile_id}.folded"), "wb") as f:
+            f.write(fetch(f"/{profile_id}/folded"))
+    click.echo(f"Downloaded {len(summaries)} profiles to {out_dir}")
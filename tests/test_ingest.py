@@ -0,0 +1,298 @@
+import os
+import sys
+# DON'T CHANGE THIS !!!
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from flask import Flask
+from datetime import date, datetime, timedelta
+import pytest
+
+from src.models.user import db
+from src.models.location import LocationPing, LatestLocation, DeviceWatermark
+from src.routes import ingest
+from src.routes.ingest import (
+    BatchInFlight, DeviceSequenceTracker, _DeviceState,
+    _format_ranges, _parse_ranges, _update_latest, location_bp
+)
+
+
+@pytest.fixture
+def app(monkeypatch):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    app.register_blueprint(location_bp, url_prefix='/api/locations')
+    monkeypatch.setattr(ingest, 'sequence_tracker', DeviceSequenceTracker(flush_interval=0))
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def tracker(app):
+    return ingest.sequence_tracker
+
+
+def make_batch(device_id, seq_start, seq_end, first_fix):
+    return {
+        "device_id": device_id,
+        "seq_start": seq_start,
+        "seq_end": seq_end,
+        "pings": [{
+            "latitude": 51.5,
+            "longitude": -0.12,
+            "recorded_at": (first_fix + timedelta(minutes=i)).isoformat() + "Z"
+        } for i in range(seq_end - seq_start + 1)]
+    }
+
+
+def claim_and_commit(tracker, device_id, seq_start, seq_end):
+    fresh = tracker.claim(device_id, seq_start, seq_end)
+    tracker.commit(device_id, fresh)
+    return fresh
+
+
+# Tracker
+
+def test_full_replay_is_dropped(tracker):
+    assert claim_and_commit(tracker, "d", 1, 10) == [(1, 10)]
+    assert tracker.claim("d", 1, 10) == []
+    assert tracker.claim("d", 3, 7) == []
+
+
+def test_partial_overlap_returns_only_new_seqs(tracker):
+    claim_and_commit(tracker, "d", 1, 10)
+    assert claim_and_commit(tracker, "d", 5, 15) == [(11, 15)]
+    assert tracker._devices["d"].high_water == 15
+
+
+def test_gap_fills_later(tracker):
+    claim_and_commit(tracker, "d", 1, 5)
+    claim_and_commit(tracker, "d", 11, 15)
+    state = tracker._devices["d"]
+    assert state.high_water == 5
+    assert state.ranges == [[11, 15]]
+
+    assert claim_and_commit(tracker, "d", 1, 20) == [(6, 10), (16, 20)]
+    assert state.high_water == 20
+    assert state.ranges == []
+
+
+def test_out_of_order_ranges_merge_into_high_water(tracker):
+    for seq_start, seq_end in [(21, 30), (11, 20), (31, 40), (1, 10)]:
+        claim_and_commit(tracker, "d", seq_start, seq_end)
+    state = tracker._devices["d"]
+    assert state.high_water == 40
+    assert state.ranges == []
+
+
+def test_pending_ranges_are_capped(tracker):
+    tracker.max_ranges = 3
+    for seq in range(10, 20, 2):
+        claim_and_commit(tracker, "d", seq, seq)
+    assert tracker._devices["d"].ranges == [[10, 10], [12, 12], [14, 14]]
+    # Forgotten ranges are handed back and left to the unique constraint
+    assert tracker.claim("d", 18, 18) == [(18, 18)]
+
+
+def test_idle_devices_are_evicted_and_flushed(tracker):
+    tracker.max_devices = 2
+    claim_and_commit(tracker, "a", 1, 5)
+    claim_and_commit(tracker, "b", 1, 5)
+    claim_and_commit(tracker, "c", 1, 5)
+    assert list(tracker._devices) == ["b", "c"]
+
+    tracker.flush(force=True)
+    assert db.session.get(DeviceWatermark, "a").high_water == 5
+    assert tracker.claim("a", 1, 5) == []
+
+
+def test_evicted_device_that_returns_is_still_flushed(tracker):
+    tracker.max_devices = 1
+    claim_and_commit(tracker, "a", 1, 5)
+    claim_and_commit(tracker, "b", 1, 5)
+    assert tracker.claim("a", 1, 5) == []
+
+    tracker.flush(force=True)
+    assert db.session.get(DeviceWatermark, "a").high_water == 5
+
+
+def test_load_does_not_hold_the_lock(tracker, monkeypatch):
+    db.session.add(DeviceWatermark(device_id="d", high_water=7, pending_ranges=""))
+    db.session.commit()
+
+    def load(device_id):
+        assert not tracker._lock.locked()
+        return DeviceSequenceTracker._load(tracker, device_id)
+
+    monkeypatch.setattr(tracker, '_load', load)
+    assert tracker.claim("d", 1, 10) == [(8, 10)]
+
+
+def test_parse_and_format_ranges_round_trip():
+    ranges = [[3, 7], [10, 10], [12, 40]]
+    assert _format_ranges(ranges) == "3-7,10-10,12-40"
+    assert _parse_ranges(_format_ranges(ranges)) == ranges
+    assert _parse_ranges("") == []
+    assert _parse_ranges(None) == []
+
+
+def test_mark_merges_neighbours():
+    state = _DeviceState(high_water=0, ranges=[[5, 6], [10, 12]])
+    DeviceSequenceTracker._mark(state, 7, 9, max_ranges=64)
+    assert state.ranges == [[5, 12]]
+    DeviceSequenceTracker._mark(state, 1, 4, max_ranges=64)
+    assert state.high_water == 12
+    assert state.ranges == []
+
+
+def test_uncommitted_claim_is_not_flushed_and_survives_failure(tracker):
+    # B claims X but has not committed
+    fresh_x = tracker.claim("X", 1, 10)
+
+    # A stores Y and flushes watermarks
+    claim_and_commit(tracker, "Y", 1, 5)
+    tracker.flush(force=True)
+    assert db.session.get(DeviceWatermark, "X") is None
+    assert db.session.get(DeviceWatermark, "Y").high_water == 5
+
+    # A replay of B's batch while it is in flight must be retried, not acknowledged
+    with pytest.raises(BatchInFlight):
+        tracker.claim("X", 1, 10)
+
+    # B fails; its retry must still store everything
+    tracker.release("X", fresh_x)
+    tracker.forget("X")
+    assert tracker.claim("X", 1, 10) == [(1, 10)]
+
+
+# Endpoint
+
+def test_replayed_batch_is_not_stored_twice(client):
+    batch = make_batch("phone", 1, 5, datetime(2025, 8, 1, 9, 0))
+    first = client.post('/api/locations/batch', json=batch).get_json()
+    replay = client.post('/api/locations/batch', json=batch).get_json()
+
+    assert first["accepted"] == 5
+    assert replay["accepted"] == 0
+    assert replay["duplicates"] == 5
+    assert LocationPing.query.count() == 5
+
+
+def test_batch_in_flight_returns_retryable_conflict(client, tracker):
+    batch = make_batch("phone", 1, 5, datetime(2025, 8, 1, 9, 0))
+    fresh = tracker.claim("phone", 1, 5)
+
+    response = client.post('/api/locations/batch', json=batch)
+    assert response.status_code == 409
+    assert response.get_json()["retry"] is True
+
+    tracker.release("phone", fresh)
+    assert client.post('/api/locations/batch', json=batch).get_json()["accepted"] == 5
+
+
+def test_late_fix_lands_in_its_own_partition(client):
+    client.post('/api/locations/batch', json=make_batch("phone", 11, 12, datetime(2025, 8, 2, 8, 0)))
+    client.post('/api/locations/batch', json=make_batch("phone", 1, 2, datetime(2025, 8, 1, 23, 0)))
+
+    history = LocationPing.query.filter_by(device_id="phone", partition_day=date(2025, 8, 1)).all()
+    assert sorted(ping.seq for ping in history) == [1, 2]
+
+
+def test_latest_does_not_move_backwards(client):
+    newer = client.post('/api/locations/batch', json=make_batch("phone", 5, 6, datetime(2025, 8, 1, 12, 0)))
+    older = client.post('/api/locations/batch', json=make_batch("phone", 1, 4, datetime(2025, 8, 1, 8, 0)))
+
+    assert newer.get_json()["latest_updated"] is True
+    assert older.get_json()["latest_updated"] is False
+    latest = db.session.get(LatestLocation, "phone")
+    assert latest.seq == 6
+    assert latest.recorded_at == datetime(2025, 8, 1, 12, 1)
+
+
+def test_state_reloads_after_forget(client, tracker):
+    batch = make_batch("phone", 1, 5, datetime(2025, 8, 1, 9, 0))
+    client.post('/api/locations/batch', json=batch)
+    tracker.flush(force=True)
+    tracker.forget("phone")
+
+    assert client.post('/api/locations/batch', json=batch).get_json()["accepted"] == 0
+    assert tracker._devices["phone"].high_water == 5
+
+
+def test_stale_tracker_reports_actual_inserts(client, monkeypatch):
+    batch = make_batch("phone", 1, 5, datetime(2025, 8, 1, 9, 0))
+    client.post('/api/locations/batch', json=batch)
+
+    # A restart before any flush loses the watermark
+    monkeypatch.setattr(ingest, 'sequence_tracker', DeviceSequenceTracker(flush_interval=0))
+    result = client.post('/api/locations/batch', json=make_batch("phone", 1, 8, datetime(2025, 8, 1, 9, 0))).get_json()
+
+    assert result["accepted"] == 3
+    assert result["duplicates"] == 5
+    assert LocationPing.query.count() == 8
+
+
+def test_boolean_seq_is_rejected(client):
+    batch = make_batch("phone", 1, 1, datetime(2025, 8, 1, 9, 0))
+    batch["seq_start"] = True
+    assert client.post('/api/locations/batch', json=batch).status_code == 400
+
+
+def test_fallback_insert_skips_stored_rows(client, monkeypatch):
+    monkeypatch.setattr(db.engine.dialect, 'name', 'mysql')
+    client.post('/api/locations/batch', json=make_batch("phone", 1, 5, datetime(2025, 8, 1, 9, 0)))
+
+    monkeypatch.setattr(ingest, 'sequence_tracker', DeviceSequenceTracker(flush_interval=0))
+    result = client.post('/api/locations/batch', json=make_batch("phone", 1, 8, datetime(2025, 8, 1, 9, 0))).get_json()
+
+    assert result["accepted"] == 3
+    assert LocationPing.query.count() == 8
+
+
+def test_latest_update_is_conditional(app):
+    fix = {"seq": 5, "latitude": 1.0, "longitude": 2.0, "accuracy": None,
+           "recorded_at": datetime(2025, 8, 1, 12, 0)}
+    assert _update_latest("phone", fix) is True
+    db.session.commit()
+
+    # An older fix from a concurrent batch must not overwrite it
+    assert _update_latest("phone", dict(fix, seq=3, recorded_at=datetime(2025, 8, 1, 11, 0))) is False
+    assert _update_latest("phone", dict(fix, seq=4)) is False
+    assert _update_latest("phone", dict(fix, seq=6)) is True
+    db.session.commit()
+    assert db.session.get(LatestLocation, "phone").seq == 6
+
+
+@pytest.mark.parametrize("field, value", [
+    ("latitude", "nan"),
+    ("latitude", "inf"),
+    ("latitude", 90.5),
+    ("longitude", "-inf"),
+    ("longitude", 181),
+    ("accuracy", "nan"),
+])
+def test_invalid_coordinates_are_rejected(client, field, value):
+    batch = make_batch("phone", 1, 1, datetime(2025, 8, 1, 9, 0))
+    batch["pings"][0][field] = value
+    assert client.post('/api/locations/batch', json=batch).status_code == 400
+    assert LocationPing.query.count() == 0
+
+
+def test_seq_beyond_bigint_is_rejected(client):
+    batch = make_batch("phone", 1, 1, datetime(2025, 8, 1, 9, 0))
+    batch["seq_start"] = batch["seq_end"] = 2 ** 63
+    assert client.post('/api/locations/batch', json=batch).status_code == 400
+
+
+def test_long_device_id_is_rejected(client):
+    batch = make_batch("x" * 65, 1, 1, datetime(2025, 8, 1, 9, 0))
+    assert client.post('/api/locations/batch', json=batch).status_code == 400
+    assert client.post('/api/locations/batch', json=make_batch("x" * 64, 1, 1, datetime(2025, 8, 1, 9, 0))).status_code == 200
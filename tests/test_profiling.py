@@ -0,0 +1,112 @@
+import os
+import sys
+# DON'T CHANGE THIS !!!
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from flask import Flask
+import pytest
+import time
+
+from src.models.user import db
+from src.routes import profiling
+from src.routes.profiling import RequestProfiler, _StackSampler
+
+ADMIN = {"X-Admin-Token": "secret"}
+
+
+def create_app(**config):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config.update(PROFILING_SLOW_MS=0, PROFILING_SAMPLE_RATE=0, PROFILING_ADMIN_TOKEN="secret")
+    app.config.update(config)
+    db.init_app(app)
+
+    @app.route('/query/<sql>')
+    def query(sql):
+        try:
+            db.session.execute(db.text(sql))
+        except Exception:
+            db.session.rollback()
+        return 'ok'
+
+    @app.route('/query-after-error')
+    def query_after_error():
+        try:
+            db.session.execute(db.text('select * from nope'))
+        except Exception:
+            db.session.rollback()
+        time.sleep(0.2)
+        db.session.execute(db.text('select 1'))
+        return 'ok'
+
+    RequestProfiler(app, db)
+    return app
+
+
+@pytest.fixture
+def client():
+    return create_app(PROFILING_ENABLED=True).test_client()
+
+
+def latest_profile(client):
+    profile_id = client.get('/api/admin/profiles', headers=ADMIN).get_json()["profiles"][0]["id"]
+    return client.get(f'/api/admin/profiles/{profile_id}', headers=ADMIN).get_json()
+
+
+def test_disabled_profiler_registers_nothing():
+    app = create_app()
+    assert app.before_request_funcs == {}
+    assert app.teardown_request_funcs == {}
+    assert app.test_client().get('/api/admin/profiles', headers=ADMIN).status_code == 404
+
+
+def test_admin_token_is_required(client):
+    assert client.get('/api/admin/profiles').status_code == 401
+    assert client.get('/api/admin/profiles', headers={"X-Admin-Token": "wrong"}).status_code == 401
+    assert client.get('/api/admin/profiles', headers={"X-Admin-Token": "é"}).status_code == 401
+
+
+def test_sql_statements_are_recorded(client):
+    client.get('/query/select 1')
+    sql = latest_profile(client)["sql"]
+    assert [query["statement"] for query in sql] == ["select 1"]
+
+
+def test_failing_statement_is_recorded(client):
+    client.get('/query-after-error')
+    failed, following = latest_profile(client)["sql"]
+    assert failed["statement"] == "select * from nope"
+    assert "no such table" in failed["error"]
+
+    # The next query is timed from its own start, not the failed one's
+    assert following["statement"] == "select 1"
+    assert "error" not in following
+    assert following["duration_ms"] < 100
+
+
+def test_profile_buffer_is_bounded():
+    client = create_app(PROFILING_ENABLED=True, PROFILING_MAX_PROFILES=2).test_client()
+    for _ in range(5):
+        client.get('/query/select 1')
+    assert len(client.get('/api/admin/profiles', headers=ADMIN).get_json()["profiles"]) == 2
+
+
+def test_stack_bytes_are_capped(monkeypatch):
+    profile = {"stacks": {}, "stack_bytes": 0, "samples": 0, "stacks_dropped": 0}
+
+    def sample(depth):
+        if depth:
+            return sample(depth - 1)
+        return sys._getframe()
+
+    _StackSampler._record(profile, sample(0))
+    budget = profile["stack_bytes"] * 3
+    monkeypatch.setattr(profiling, 'MAX_STACK_BYTES', budget)
+    for depth in range(1, 20):
+        _StackSampler._record(profile, sample(depth))
+
+    assert 1 < len(profile["stacks"]) < 20
+    assert profile["stack_bytes"] <= budget
+    assert sum(len(key) for key in profile["stacks"]) == profile["stack_bytes"]
+    assert profile["stacks_dropped"] == 20 - len(profile["stacks"])